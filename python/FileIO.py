@@ -1,3 +1,5 @@
+from Stream import Stream, StreamType
+
 def write(args):
 	with open(str(args[0])[1:-1], "w+") as f:
 		f.write(''.join(args[1:])[1:-1])
@@ -10,5 +12,21 @@ def read(args):
 	with open(str(args[0])[1:-1], "r", encoding="utf-8") as f:
 		return f.read()
 
+def _read_lines(path):
+	with open(path, "r", encoding="utf-8") as f:
+		for line in f:
+			yield line.rstrip("\n")
+
+# Reads the file one line at a time as the stream is used, so big files are
+# never loaded all at once.
+def lines(args):
+	path = args[0]
+	return Stream(lambda: _read_lines(path))
+
+def _lines_type(types):
+	if types != ["str"]:
+		raise TypeError("FileIO.lines needs the path of the file as a str.")
+	return StreamType("str")
+
 def _values():
-	return {"write": None, "append": None, "read": None}
\ No newline at end of file
+	return {"write": None, "append": None, "read": None, "lines": _lines_type}
\ No newline at end of file
@@ -0,0 +1,204 @@
+import builtins
+
+MAP = "map"
+FILTER = "filter"
+TAKE = "take"
+
+class StreamType:
+	__slots__ = ("item",)
+
+	def __init__(self, item):
+		self.item = item
+
+	def __eq__(self, other):
+		return type(other) is StreamType and self.item == other.item
+
+	def __hash__(self):
+		return hash((StreamType, self.item))
+
+	def __str__(self):
+		return "stream[%s]" % _type_str(self.item)
+
+# A stream doesn't hold any items. It holds a function that starts its source
+# and the stages to pass each item through, so nothing is computed until
+# something loops over it, and looping over it again starts over.
+class Stream:
+	__slots__ = ("source", "stages")
+
+	def __init__(self, source, stages=()):
+		self.source = source
+		self.stages = stages
+
+	def then(self, kind, argument):
+		return Stream(self.source, self.stages + ((kind, argument),))
+
+	def __iter__(self):
+		return _run(self.source(), self.stages)
+
+# All the stages run in one loop, one item at a time, instead of each stage
+# making a list for the next one.
+def _run(source, stages):
+	remaining = [argument if kind == TAKE else None for kind, argument in stages]
+	if any(left is not None and left <= 0 for left in remaining):
+		return
+	for item in source:
+		last = False
+		for index, (kind, argument) in enumerate(stages):
+			if kind == MAP:
+				item = argument.run([item])
+			elif kind == FILTER:
+				if not argument.run([item]):
+					break
+			else:
+				remaining[index] -= 1
+				if remaining[index] == 0:
+					last = True
+		else:
+			yield item
+		# Stop before taking anything else from the source once a `take` has
+		# all of its items.
+		if last:
+			return
+
+def _split(text, separator):
+	start = 0
+	while True:
+		end = text.find(separator, start)
+		if end == -1:
+			yield text[start:]
+			return
+		yield text[start:end]
+		start = end + len(separator)
+
+# Sources. The commands are named like Python's builtins, so those are used
+# through `builtins` in this file.
+
+def range(args):
+	return Stream(lambda: iter(builtins.range(args[0])))
+
+def split(args):
+	text, separator = args
+	# Like Python's `str.split`, since splitting by "" would never end.
+	if separator == "":
+		raise ValueError("Stream.split can't split by an empty string.")
+	return Stream(lambda: _split(text, separator))
+
+# Stages
+
+def map(args):
+	stream, function = args
+	return stream.then(MAP, function)
+
+def filter(args):
+	stream, function = args
+	return stream.then(FILTER, function)
+
+def take(args):
+	stream, count = args
+	return stream.then(TAKE, count)
+
+# Results
+
+def fold(args):
+	stream, function, value = args
+	for item in stream:
+		value = function.run([value, item])
+	return value
+
+def sum(args):
+	total = 0
+	for item in args[0]:
+		total += item
+	return total
+
+def count(args):
+	total = 0
+	for _ in args[0]:
+		total += 1
+	return total
+
+# Types
+
+def _type_str(n_type):
+	if isinstance(n_type, tuple):
+		return ' -> '.join(_type_str(part) for part in n_type)
+	return str(n_type)
+
+def _check_arguments(command, types, expected):
+	if len(types) != len(expected):
+		raise TypeError("Stream.%s takes %d argument(s), but you gave %d." % (command, len(expected), len(types)))
+
+def _item_type(command, n_type):
+	if not isinstance(n_type, StreamType):
+		raise TypeError("Stream.%s needs a stream, not a %s." % (command, _type_str(n_type)))
+	return n_type.item
+
+def _function_type(command, n_type, argument_types):
+	if not isinstance(n_type, tuple) or n_type[:-1] != argument_types:
+		raise TypeError("Stream.%s needs a %s -> something function, not a %s." % (command, ' -> '.join(_type_str(t) for t in argument_types), _type_str(n_type)))
+	return n_type[-1]
+
+def _range_type(types):
+	_check_arguments("range", types, ["int"])
+	if types[0] != "int":
+		raise TypeError("Stream.range needs an int, not a %s." % _type_str(types[0]))
+	return StreamType("int")
+
+def _split_type(types):
+	_check_arguments("split", types, ["str", "str"])
+	if types != ["str", "str"]:
+		raise TypeError("Stream.split needs a str to split and a str to split by.")
+	return StreamType("str")
+
+def _map_type(types):
+	_check_arguments("map", types, ["stream", "function"])
+	item = _item_type("map", types[0])
+	return StreamType(_function_type("map", types[1], (item,)))
+
+def _filter_type(types):
+	_check_arguments("filter", types, ["stream", "function"])
+	item = _item_type("filter", types[0])
+	if _function_type("filter", types[1], (item,)) != "bool":
+		raise TypeError("Stream.filter needs a function that returns a bool.")
+	return types[0]
+
+def _take_type(types):
+	_check_arguments("take", types, ["stream", "int"])
+	_item_type("take", types[0])
+	if types[1] != "int":
+		raise TypeError("Stream.take needs an int for how many items to take.")
+	return types[0]
+
+def _fold_type(types):
+	_check_arguments("fold", types, ["stream", "function", "value"])
+	item = _item_type("fold", types[0])
+	value = types[2]
+	if _function_type("fold", types[1], (value, item)) != value:
+		raise TypeError("Stream.fold needs a function that returns a %s." % _type_str(value))
+	return value
+
+def _sum_type(types):
+	_check_arguments("sum", types, ["stream"])
+	item = _item_type("sum", types[0])
+	if item != "int" and item != "float":
+		raise TypeError("Stream.sum can only add up ints or floats, not %s." % _type_str(item))
+	return item
+
+def _count_type(types):
+	_check_arguments("count", types, ["stream"])
+	_item_type("count", types[0])
+	return "int"
+
+# Return types that depend on the argument types are functions that take the
+# argument types.
+def _values():
+	return {
+		"range": _range_type,
+		"split": _split_type,
+		"map": _map_type,
+		"filter": _filter_type,
+		"take": _take_type,
+		"fold": _fold_type,
+		"sum": _sum_type,
+		"count": _count_type,
+	}
@@ -4,9 +4,18 @@ import importlib
 from lark import Lark
 from lark import Transformer
 from lark import tree
+from lark import v_args
 import lark
+import sys
 from colorama import init, Fore, Style
 import argparse
+from array import array
+import io
+import os
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from Stream import StreamType
 init()
 
 class Variable:
@@ -49,13 +58,225 @@ class NativeFunction(Function):
 			return NativeFunction(self.scope, self.arguments, self.return_type, self.function, argument_cache=self.argument_cache + arguments)
 		return self.function(*arguments)
 
+# The checker and evaluator work on a lowered copy of Lark's parse tree. Lark
+# Trees and Tokens each carry a `meta`/position fields, and tokens keep their
+# source text, so a compact tree is built instead where literals are already
+# decoded. Positions are kept in a flat array in `File` for error messages
+# only; `position` is an index into it, or None for generated nodes.
+class Node:
+	__slots__ = ("data", "children", "position")
+
+	def __init__(self, data, children, position=None):
+		self.data = data
+		self.children = children
+		self.position = position
+
+class Leaf:
+	__slots__ = ("type", "value", "position")
+
+	def __init__(self, type, value, position=None):
+		self.type = type
+		self.value = value
+		self.position = position
+
+# `offset` is the index of the field in the tuple, which the type checker
+# works out so evaluating the access is just indexing.
+class FieldAccess(Node):
+	__slots__ = ("offset",)
+
+	def __init__(self, data, children, position=None):
+		super(FieldAccess, self).__init__(data, children, position)
+		self.offset = None
+
+# Records are stored as tuples with their fields sorted by name, but the fields
+# are evaluated in the order they're written. `order` is the index of each
+# field in `children` in the tuple's order.
+class Record(Node):
+	__slots__ = ("order",)
+
+	def __init__(self, data, children, position=None):
+		super(Record, self).__init__(data, children, position)
+		self.order = tuple(sorted(range(len(children)), key=lambda index: children[index].children[0].value))
+
+# Tuples and records are both Python tuples when the program runs, so `print`
+# keeps the type of its value, which the type checker sets, to show the field
+# names of records.
+class Print(Node):
+	__slots__ = ("value_type",)
+
+	def __init__(self, data, children, position=None):
+		super(Print, self).__init__(data, children, position)
+		self.value_type = None
+
+# `free_variables` are the names that the function uses from the scope it's
+# defined in, which are the only variables its closure needs to keep.
+class FunctionDef(Node):
+	__slots__ = ("free_variables",)
+
+	def __init__(self, data, children, position=None):
+		super(FunctionDef, self).__init__(data, children, position)
+		self.free_variables = get_free_variables(children[0], children[-1])
+
+def get_free_variables(arguments, codeblock):
+	free = set()
+	find_free_variables(codeblock, set(get_name_type(arg)[0] for arg in arguments.children), free)
+	return tuple(free)
+
+# This follows the scoping in `Scope.eval_command`: code blocks and the bodies
+# of `for`s and `if`s get their own scope, and declarations only count after
+# their value.
+def find_free_variables(tree, bound, free):
+	if type(tree) is Leaf:
+		if tree.type == "NAME" and tree.value not in bound:
+			free.add(tree.value)
+	elif tree.data == "code_block":
+		bound = set(bound)
+		for instruction in tree.children:
+			find_free_variables(instruction, bound, free)
+	elif tree.data == "instruction":
+		command = tree.children[0]
+		if command.data == "declare":
+			name_type, value = command.children
+			find_free_variables(value, bound, free)
+			bound.add(get_name_type(name_type)[0])
+		elif command.data == "for" or command.data == "parallel_for":
+			var, iterable, code = command.children
+			find_free_variables(iterable, bound, free)
+			find_free_variables(code, bound | {get_name_type(var)[0]}, free)
+		elif command.data == "if" or command.data == "ifelse":
+			condition, *bodies = command.children
+			find_free_variables(condition, bound, free)
+			for body in bodies:
+				find_free_variables(body, set(bound), free)
+		elif command.data != "imp":
+			find_free_variables(command, bound, free)
+	elif tree.data == "function_def" or tree.data == "anonymous_func":
+		free.update(name for name in tree.free_variables if name not in bound)
+	elif tree.data == "imported_command":
+		for argument in tree.children[2:]:
+			find_free_variables(argument, bound, free)
+	elif tree.data == "record":
+		for field in tree.children:
+			find_free_variables(field.children[1], bound, free)
+	elif tree.data == "field_access":
+		find_free_variables(tree.children[0], bound, free)
+	else:
+		for child in tree.children:
+			find_free_variables(child, bound, free)
+
+def decode_literal(token):
+	if token.type == "NUMBER":
+		# QUESTION: Float or int?
+		if "." in token.value:
+			return float(token)
+		return int(token)
+	elif token.type == "INT":
+		return int(token)
+	elif token.type == "STRING":
+		# TODO: Character escapes
+		return str(token[1:-1])
+	elif token.type == "BOOLEAN":
+		if token.value == "false":
+			return False
+		elif token.value == "true":
+			return True
+		else:
+			raise SyntaxError("Unexpected boolean value %s" % token.value)
+	# Names and operators are repeated a lot, so share their strings.
+	return sys.intern(str(token))
+
+class Lower(Transformer):
+	def __init__(self, file):
+		super(Lower, self).__init__(visit_tokens=True)
+		self.file = file
+
+	def __default__(self, data, children, meta):
+		return self.node(data, tuple(children), meta)
+
+	def __default_token__(self, token):
+		position = self.file.add_position(token.line, token.column, token.end_line, token.end_column)
+		return Leaf(token.type, decode_literal(token), position)
+
+	def node(self, data, children, meta, node_class=Node):
+		if meta.empty:
+			return node_class(data, children)
+		return node_class(data, children, self.file.add_position(meta.line, meta.column, meta.end_line, meta.end_column))
+
+	def type_leaf(self, meta, n_type):
+		return Leaf("TYPE", n_type, self.file.add_position(meta.line, meta.column, meta.end_line, meta.end_column))
+
+	# `value` only wraps a single token or expression, so it's dropped, except
+	# around a comparison in parentheses so that `(a < b) == c` isn't read as
+	# the chain `a < b == c`.
+	@v_args(meta=True)
+	def value(self, children, meta):
+		child = children[0]
+		if type(child) is Node and child.data == "compare_expression":
+			return self.node("value", (child,), meta)
+		return child
+
+	@v_args(meta=True)
+	def function_def(self, children, meta):
+		return self.node("function_def", tuple(children), meta, node_class=FunctionDef)
+
+	# Give anonymous functions a code block so they can be treated like
+	# `function_def`s.
+	@v_args(meta=True)
+	def anonymous_func(self, children, meta):
+		arguments, returntype, *instructions = children
+		return self.node("anonymous_func", (arguments, returntype, Node("code_block", tuple(instructions))), meta, node_class=FunctionDef)
+
+	@v_args(meta=True)
+	def print(self, children, meta):
+		return self.node("print", tuple(children), meta, node_class=Print)
+
+	@v_args(meta=True)
+	def record(self, children, meta):
+		return self.node("record", tuple(children), meta, node_class=Record)
+
+	@v_args(meta=True)
+	def field_access(self, children, meta):
+		return self.node("field_access", tuple(children), meta, node_class=FieldAccess)
+
+	# Types are turned into TYPE leaves so that, like a plain NAME type, the
+	# type is always the leaf's value.
+	@v_args(meta=True)
+	def tuple_type(self, children, meta):
+		return self.type_leaf(meta, TupleType(tuple(child.value for child in children)))
+
+	@v_args(meta=True)
+	def record_type(self, children, meta):
+		fields = {}
+		for name, field_type in zip(children[::2], children[1::2]):
+			if name.value in fields:
+				self.file.errors.append(TypeCheckError(name, "The record type already has a field named %s." % name.value))
+			else:
+				fields[name.value] = field_type.value
+		return self.type_leaf(meta, RecordType(tuple(sorted(fields.items()))))
+
+	@v_args(meta=True)
+	def stream_type(self, children, meta):
+		return self.type_leaf(meta, StreamType(children[0].value))
+
 class File:
 	def __init__(self, file, tab_length=4):
 		self.lines = [line.rstrip().replace('\t', ' ' * tab_length) for line in file]
 		self.line_num_width = len(str(len(self.lines)))
+		# Four numbers per position: line, column, end line and end column.
+		self.positions = array("I")
+		# Errors found while lowering, which are reported with the type
+		# checker's.
+		self.errors = []
 
 	def parse(self, parser):
-		return parser.parse('\n'.join(self.lines))
+		return Lower(self).transform(parser.parse('\n'.join(self.lines)))
+
+	def add_position(self, line, column, end_line, end_column):
+		self.positions.extend((line, column, end_line, end_column))
+		return len(self.positions) // 4 - 1
+
+	def get_position(self, position):
+		return self.positions[position * 4:position * 4 + 4]
 
 	def get_line(self, line):
 		return self.lines[line - 1]
@@ -87,8 +308,8 @@ class File:
 
 class TypeCheckError:
 	def __init__(self, token_or_tree, message):
-		if type(token_or_tree) is not lark.Token and type(token_or_tree) is not lark.Tree:
-			raise TypeError("token_or_tree should be a Lark Token or Tree.")
+		if not isinstance(token_or_tree, (Leaf, Node)):
+			raise TypeError("token_or_tree should be a Leaf or Node.")
 		self.datum = token_or_tree
 		self.message = message
 
@@ -103,23 +324,9 @@ class TypeCheckError:
 		else:
 			raise ValueError("%s is not a valid display type for TypeCheckError." % display_type)
 		output += ": %s\n" % self.message
-		if type(self.datum) is lark.Token:
-			output += f"{Fore.CYAN} --> {Fore.BLUE}run.n:{self.datum.line}:{self.datum.column}{Style.RESET_ALL}\n"
-			output += file.display(
-				self.datum.line,
-				self.datum.column,
-				self.datum.end_line,
-				self.datum.end_column,
-			)
-		else:
-			output += f"{Fore.CYAN} --> {Fore.BLUE}run.n:{self.datum.line}:{self.datum.column}{Style.RESET_ALL}\n"
-			output += file.display(
-				self.datum.line,
-				self.datum.column,
-				self.datum.end_line,
-				self.datum.end_column,
-				color
-			)
+		line, column, end_line, end_column = file.get_position(self.datum.position)
+		output += f"{Fore.CYAN} --> {Fore.BLUE}run.n:{line}:{column}{Style.RESET_ALL}\n"
+		output += file.display(line, column, end_line, end_column, color)
 		return output
 
 # TODO: Move these into Scope because one day these might be scoped due to
@@ -143,11 +350,64 @@ unary_operation_types = {
 comparable_types = ["int", "float"]
 iterable_types = { "int": "int" }
 
+# Tuples and records are both tuples at run time. A record's fields are a tuple
+# of (name, type) pairs sorted by name, and a field's offset is its index.
+class TupleType:
+	__slots__ = ("types",)
+
+	def __init__(self, types):
+		self.types = types
+
+	def __eq__(self, other):
+		return type(other) is TupleType and self.types == other.types
+
+	def __hash__(self):
+		return hash(self.types)
+
+	def __str__(self):
+		return "(%s)" % ", ".join(type_to_str(n_type) for n_type in self.types)
+
+class RecordType:
+	__slots__ = ("fields",)
+
+	def __init__(self, fields):
+		self.fields = fields
+
+	def __eq__(self, other):
+		return type(other) is RecordType and self.fields == other.fields
+
+	def __hash__(self):
+		return hash(self.fields)
+
+	def __str__(self):
+		return "{%s}" % ", ".join("%s: %s" % (name, type_to_str(n_type)) for name, n_type in self.fields)
+
+	def get_offset(self, name):
+		for offset, (field_name, _) in enumerate(self.fields):
+			if field_name == name:
+				return offset
+
+def type_to_str(n_type):
+	if isinstance(n_type, tuple):
+		return ' -> '.join(type_to_str(part) for part in n_type)
+	return str(n_type)
+
+def value_to_str(value, n_type):
+	if isinstance(n_type, RecordType):
+		return "{%s}" % ", ".join("%s: %s" % (name, item_to_str(item, item_type)) for (name, item_type), item in zip(n_type.fields, value))
+	elif isinstance(n_type, TupleType):
+		return "(%s)" % ", ".join(item_to_str(item, item_type) for item_type, item in zip(n_type.types, value))
+	return str(value)
+
+# Strings inside tuples and records are shown in quotes, like in N code.
+def item_to_str(value, n_type):
+	if n_type == "str":
+		return '"%s"' % value
+	return value_to_str(value, n_type)
+
 def display_type(n_type):
-	if isinstance(n_type, str):
-		return Fore.YELLOW + n_type + Style.RESET_ALL
-	elif isinstance(n_type, tuple):
-		return Fore.YELLOW + ' -> '.join(n_type) + Style.RESET_ALL
+	if isinstance(n_type, (str, tuple, TupleType, RecordType, StreamType)):
+		return Fore.YELLOW + type_to_str(n_type) + Style.RESET_ALL
 	else:
 		print('display_type was given a value that is neither a string nor a tuple.', n_type)
 		return Fore.RED + '???' + Style.RESET_ALL
@@ -192,6 +452,18 @@ class Scope:
 		else:
 			return variable
 
+	"""
+	Creates a scope for a closure with only the variables that it uses, so the
+	closure doesn't keep the rest of this scope and its parents alive.
+	"""
+	def capture(self, names):
+		scope = Scope(errors=self.errors, warnings=self.warnings, imports=self.imports)
+		for name in names:
+			variable = self.get_variable(name, err=False)
+			if variable is not None:
+				scope.variables[name] = variable
+		return scope
+
 	def get_parent_function(self):
 		if self.parent_function is None:
 			if self.parent:
@@ -202,31 +474,19 @@ class Scope:
 			return self.parent_function
 
 	def eval_value(self, value):
-		if value.type == "NUMBER":
-			# QUESTION: Float or int?
-			if "." in str(value.value):
-				return float(value)
-			return int(value)
-		elif value.type == "STRING":
-			# TODO: Character escapes
-			return value[1:-1]
-		elif value.type == "BOOLEAN":
-			if value.value == "false":
-				return False
-			elif value.value == "true":
-				return True
-			else:
-				raise SyntaxError("Unexpected boolean value %s" % value.value)
-		elif value.type == "NAME":
+		if value.type == "NAME":
 			return self.get_variable(value.value).value
+		elif value.type == "NUMBER" or value.type == "STRING" or value.type == "BOOLEAN":
+			# Literals were already decoded when the tree was lowered.
+			return value.value
 		else:
 			raise SyntaxError("Unexpected value type %s value %s" % (value.type, value.value))
 
 	"""
-	Evaluate a parsed expression with Trees and Tokens from Lark.
+	Evaluate a lowered expression made of Nodes and Leaves.
 	"""
 	def eval_expr(self, expr):
-		if type(expr) is lark.Token:
+		if type(expr) is Leaf:
 			return self.eval_value(expr)
 
 		if expr.data == "ifelse_expr":
@@ -235,30 +495,31 @@ class Scope:
 				return self.eval_expr(if_true)
 			else:
 				return self.eval_expr(if_false)
-		elif expr.data == "function_def":
+		elif expr.data == "function_def" or expr.data == "anonymous_func":
 			arguments, returntype, codeblock = expr.children
 			return Function(
-				self,
+				self.capture(expr.free_variables),
 				[(arg.children[0].value, arg.children[1].value) for arg in arguments.children],
 				returntype.value,
 				codeblock
 			)
-		elif expr.data == "anonymous_func":
-			arguments, returntype, *codeblock = expr.children
-			return Function(
-				self,
-				[(arg.children[0].value, arg.children[1].value) for arg in arguments.children],
-				returntype.value,
-				lark.tree.Tree("codeblock", codeblock)
-			)
 		elif expr.data == "function_callback":
 			function, *arguments = expr.children[0].children
 			return self.eval_expr(function).run([self.eval_expr(arg) for arg in arguments])
 		elif expr.data == "imported_command":
 			l, c, *args = expr.children
-			library = self.find_import(l)
-			com = getattr(library, c)
-			return com([self.eval_expr(a.children[0]) for a in args])
+			library = self.find_import(l.value)
+			com = getattr(library, c.value)
+			return com([self.eval_expr(a) for a in args])
+		elif expr.data == "value":
+			return self.eval_expr(expr.children[0])
+		elif expr.data == "tuple":
+			return tuple([self.eval_expr(item) for item in expr.children])
+		elif expr.data == "record":
+			values = [self.eval_expr(field.children[1]) for field in expr.children]
+			return tuple([values[index] for index in expr.order])
+		elif expr.data == "field_access":
+			return self.eval_expr(expr.children[0])[expr.offset]
 		elif expr.data == "or_expression":
 			left, _, right = expr.children
 			return self.eval_expr(left) or self.eval_expr(right)
@@ -274,7 +535,7 @@ class Scope:
 			# lot of comparison operators.
 			# For example, (1 = 2) = 3 (in code as `1 = 2 = 3`).
 			left, comparison, right = expr.children
-			if left.data == "compare_expression":
+			if type(left) is Node and left.data == "compare_expression":
 				# If left side is a comparison, it also needs to be true for the
 				# entire expression to be true.
 				if not self.eval_expr(left):
@@ -327,40 +588,45 @@ class Scope:
 				return -self.eval_expr(value)
 			else:
 				raise SyntaxError("Unexpected operation for unary_expression: %s" % operation)
-		elif expr.data == "value":
-			token_or_tree = expr.children[0]
-			if type(token_or_tree) is lark.Tree:
-				return self.eval_expr(token_or_tree)
-			else:
-				return self.eval_value(token_or_tree)
 		else:
 			print('(parse tree):', expr)
 			raise SyntaxError("Unexpected command/expression type %s" % expr.data)
 
 	"""
-	Evaluates a command given parsed Trees and Tokens from Lark.
+	Evaluates a command given lowered Nodes and Leaves.
 	"""
 	def eval_command(self, tree):
-		if tree.data != "instruction":
-			raise SyntaxError("Command %s not implemented" %(t.data))
+		if not isinstance(tree, Node) or tree.data != "instruction":
+			raise SyntaxError("Command %s not implemented" % (tree.data if isinstance(tree, Node) else tree.type))
 
 		command = tree.children[0]
 
 		if command.data == "imp":
-			self.imports.append(importlib.import_module(command.children[0]))
+			self.imports.append(importlib.import_module(command.children[0].value))
 		elif command.data == "for":
 			var, iterable, code = command.children
 			name, type = get_name_type(var)
-			for i in range(int(iterable)):
-				scope = self.new_scope()
-
-				scope.variables[name] = Variable(type, i)
-				for child in code.children:
-					exit, value = scope.eval_command(child)
-					if exit:
-						return (True, value)
+			iterable = self.eval_expr(iterable)
+			if isinstance(iterable, int):
+				iterable = range(iterable)
+			exit, value = self.eval_for(name, type, iterable, code)
+			if exit:
+				return (True, value)
+		elif command.data == "parallel_for":
+			var, iterable, code = command.children
+			name, type = get_name_type(var)
+			iterable = self.eval_expr(iterable)
+			# Parallel loops inside a parallel loop's iterations just run in
+			# the worker. Streams are read one item at a time, so looping over
+			# them in parallel runs in order here too.
+			if isinstance(iterable, int) and args.jobs > 1 and parallel_loop is None and "fork" in multiprocessing.get_all_start_methods():
+				self.eval_parallel_for(name, type, iterable, code)
+			else:
+				if isinstance(iterable, int):
+					iterable = range(iterable)
+				self.eval_for(name, type, iterable, code)
 		elif command.data == "print":
-			print(self.eval_expr(command.children[0]))
+			print(value_to_str(self.eval_expr(command.children[0]), command.value_type))
 		elif command.data == "return":
 			return (True, self.eval_expr(command.children[0]))
 		elif command.data == "declare":
@@ -387,11 +653,43 @@ class Scope:
 		# No return
 		return (False, None)
 
+	def eval_for(self, name, type, iterable, code):
+		for i in iterable:
+			scope = self.new_scope()
+
+			scope.variables[name] = Variable(type, i)
+			for child in code.children:
+				exit, value = scope.eval_command(child)
+				if exit:
+					return (True, value)
+		return (False, None)
+
+	"""
+	Runs the iterations of a parallel for loop in chunks on a pool of worker
+	processes. The type checker has made sure the iterations don't depend on
+	each other, so the only thing to put back in order is what they print.
+	"""
+	def eval_parallel_for(self, name, type, iterations, code):
+		global parallel_loop
+		chunk_size = max(1, -(-iterations // (args.jobs * 4)))
+		starts = range(0, iterations, chunk_size)
+		stops = [min(start + chunk_size, iterations) for start in starts]
+		# Forked workers would otherwise print anything still in the buffer
+		# again when they exit.
+		sys.stdout.flush()
+		parallel_loop = (self, name, type, code)
+		try:
+			with ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+				for output in executor.map(run_parallel_chunk, starts, stops):
+					sys.stdout.write(output)
+		finally:
+			parallel_loop = None
+
 	def get_value_type(self, value):
 		if value.type == "NUMBER":
 			# TODO: We should return a generic `number` type and then try to
 			# figure it out later.
-			if "." in str(value.value):
+			if type(value.value) is float:
 				return "float"
 			return "int"
 		elif value.type == "STRING":
@@ -412,7 +710,7 @@ class Scope:
 	Type checks an expression and returns its type.
 	"""
 	def type_check_expr(self, expr):
-		if type(expr) is lark.Token:
+		if type(expr) is Leaf:
 			return self.get_value_type(expr)
 
 		if expr.data == "ifelse_expr":
@@ -427,13 +725,13 @@ class Scope:
 			if if_true_type != if_false_type:
 				self.errors.append(TypeCheckError(expr, "The branches of the if-else expression should have the same type, but the true branch has type %s while the false branch has type %s." % (display_type(if_true_type), display_type(if_false_type))))
 				return None
-			if type(condition.children[0]) is lark.Token:
-				if condition.children[0].value == "true":
+			if type(condition) is Leaf and condition.type == "BOOLEAN":
+				if condition.value:
 					self.warnings.append(TypeCheckError(condition, "The else statement of the expression will never run."))
-				if condition.children[0].value == "false":
+				else:
 					self.warnings.append(TypeCheckError(condition, "The if statement of the expression will never run."))
 			return if_true_type
-		elif expr.data == "function_def":
+		elif expr.data == "function_def" or expr.data == "anonymous_func":
 			arguments, returntype, codeblock = expr.children
 			arguments = [(arg.children[0].value, arg.children[1].value) for arg in arguments.children]
 			dummy_function = Function(self, arguments, returntype.value, codeblock)
@@ -450,24 +748,6 @@ class Scope:
 					warned = True
 					self.warnings.append(TypeCheckError(exit_point, "There are commands after this return statement, but I will never run them."))
 			return dummy_function.type
-		elif expr.data == "anonymous_func":
-			arguments, returntype, *cb = expr.children
-			codeblock = lark.tree.Tree("codeblock", cb)
-			arguments = [(arg.children[0].value, arg.children[1].value) for arg in arguments.children]
-			dummy_function = Function(self, arguments, returntype.value, codeblock)
-			scope = self.new_scope(parent_function=dummy_function)
-			for arg_name, arg_type in arguments:
-				scope.variables[arg_name] = Variable(arg_type, "anything")
-			exit_point = None
-			warned = False
-			for instruction in codeblock.children:
-				exit = scope.type_check_command(instruction)
-				if exit and exit_point is None:
-					exit_point = exit
-				elif exit_point and not warned:
-					warned = True
-					self.warnings.append(TypeCheckError(exit_point, "There are commands after this return statement, but I will never run them."))
-			return dummy_function.type
 		elif expr.data == "function_callback":
 			function, *arguments = expr.children[0].children
 			func_type = self.type_check_expr(function)
@@ -490,26 +770,62 @@ class Scope:
 				return return_type
 		elif expr.data == "imported_command":
 			l, c, *args = expr.children
-			library = self.find_import(l)
+			arg_types = [self.type_check_expr(arg) for arg in args]
+			library = self.find_import(l.value)
 			if library == None:
-				self.errors.append(TypeCheckError(l, "Library %s not found." % l))
+				self.errors.append(TypeCheckError(l, "Library %s not found." % l.value))
 			else:
 				try:
-					if c not in library._values():
-						self.errors.append(TypeCheckError(c, "Command %s in %s not found." % c, l))
-					else:
-						return library._values[c]
-				except:
-					pass
+					values = library._values()
+				except AttributeError:
+					return None
+				if c.value not in values:
+					self.errors.append(TypeCheckError(c, "Command %s in %s not found." % (c.value, l.value)))
+				elif callable(values[c.value]):
+					if None in arg_types:
+						return None
+					try:
+						return values[c.value](arg_types)
+					except TypeError as err:
+						self.errors.append(TypeCheckError(expr, str(err)))
+				else:
+					return values[c.value]
 			return None
 		elif expr.data == "value":
-			token_or_tree = expr.children[0]
-			if type(token_or_tree) is lark.Tree:
-				return self.type_check_expr(token_or_tree)
-			else:
-				return self.get_value_type(token_or_tree)
+			return self.type_check_expr(expr.children[0])
+		elif expr.data == "tuple":
+			types = [self.type_check_expr(item) for item in expr.children]
+			if None in types:
+				return None
+			return TupleType(tuple(types))
+		elif expr.data == "record":
+			fields = []
+			for index in expr.order:
+				name, value = expr.children[index].children
+				if fields and fields[-1][0] == name.value:
+					self.errors.append(TypeCheckError(name, "The record already has a field named %s." % name.value))
+				fields.append((name.value, self.type_check_expr(value)))
+			if any(field_type is None for _, field_type in fields):
+				return None
+			return RecordType(tuple(fields))
+		elif expr.data == "field_access":
+			value, field = expr.children
+			value_type = self.type_check_expr(value)
+			if value_type is None:
+				return None
+			if isinstance(value_type, TupleType) and field.type == "INT":
+				if field.value < len(value_type.types):
+					expr.offset = field.value
+					return value_type.types[field.value]
+			elif isinstance(value_type, RecordType) and field.type == "NAME":
+				offset = value_type.get_offset(field.value)
+				if offset is not None:
+					expr.offset = offset
+					return value_type.fields[offset][1]
+			self.errors.append(TypeCheckError(field, "A %s doesn't have a field %s." % (display_type(value_type), field.value)))
+			return None
 
-		if len(expr.children) == 2 and type(expr.children[0]) is lark.Token:
+		if len(expr.children) == 2 and type(expr.children[0]) is Leaf:
 			operation, value = expr.children
 			types = unary_operation_types.get(operation.type)
 			if types:
@@ -526,7 +842,7 @@ class Scope:
 		# For now, we assert that both operands are of the same time. In the
 		# future, when we add traits for operations, this assumption may no
 		# longer hold.
-		if len(expr.children) == 3 and type(expr.children[1]) is lark.Token:
+		if len(expr.children) == 3 and type(expr.children[1]) is Leaf:
 			left, operation, right = expr.children
 			types = binary_operation_types.get(operation.type)
 			if types:
@@ -546,7 +862,7 @@ class Scope:
 					return return_type
 			elif expr.data == "compare_expression":
 				left, comparison, right = expr.children
-				if left.data == "compare_expression":
+				if type(left) is Node and left.data == "compare_expression":
 					# We'll assume that any type errors will have been logged,
 					# so this can only return 'bool' or None. We don't care
 					# either way.
@@ -578,34 +894,39 @@ class Scope:
 	to determine if any code is unreachable.
 	"""
 	def type_check_command(self, tree):
-		if tree.data != "instruction":
-			self.errors.append(TypeCheckError(tree, "Internal problem: I only deal with instructions, not %s." % tree.data))
+		if not isinstance(tree, Node) or tree.data != "instruction":
+			self.errors.append(TypeCheckError(tree, "Internal problem: I only deal with instructions, not %s." % (tree.data if isinstance(tree, Node) else tree.type)))
 			return False
 
 		command = tree.children[0]
 
 		if command.data == "imp":
 			try:
-				imp = importlib.import_module(command.children[0])
+				imp = importlib.import_module(command.children[0].value)
 				self.imports.append(imp)
 				try:
 					getattr(imp, "_values")
 				except:
-					self.errors.append(TypeCheckError(command.children[0], "Library %s not compatable." % command.children[0]))
+					self.errors.append(TypeCheckError(command.children[0], "Library %s not compatable." % command.children[0].value))
 			except:
-				self.errors.append(TypeCheckError(command.children[0], "Library %s not found to import." % command.children[0]))
-		elif command.data == "for":
+				self.errors.append(TypeCheckError(command.children[0], "Library %s not found to import." % command.children[0].value))
+		elif command.data == "for" or command.data == "parallel_for":
 			var, iterable, code = command.children
 			name, type = get_name_type(var)
+			if command.data == "parallel_for":
+				self.check_parallel_body(code)
 			iterable_type = self.type_check_expr(iterable)
-			iterated_type = iterable_types.get(iterable_type)
+			if isinstance(iterable_type, StreamType):
+				iterated_type = iterable_type.item
+			else:
+				iterated_type = iterable_types.get(iterable_type)
 			if iterable_type is not None:
 				if iterated_type is None:
 					self.errors.append(TypeCheckError(iterable, "I can't loop over a %s." % display_type(iterable_type)))
 				elif type == 'infer':
 					type = iterated_type
 				elif type != iterated_type:
-					self.errors.append(TypeCheckError(type, "Looping over a %s produces %s values, not %s." % (display_type(iterable_type), display_type(iterated_type), display_type(type))))
+					self.errors.append(TypeCheckError(var, "Looping over a %s produces %s values, not %s." % (display_type(iterable_type), display_type(iterated_type), display_type(type))))
 			scope = self.new_scope()
 			scope.variables[name] = Variable(type, "whatever")
 			exit_point = False
@@ -618,7 +939,7 @@ class Scope:
 		elif command.data == "print":
 			# NOTE: In JS, `print` will be an indentity function, but since it's
 			# a command in Python, it won't return anything.
-			self.type_check_expr(command.children[0])
+			command.value_type = self.type_check_expr(command.children[0])
 		elif command.data == "return":
 			return_type = self.type_check_expr(command.children[0])
 			parent_function = self.get_parent_function()
@@ -660,9 +981,231 @@ class Scope:
 		# No return
 		return False
 
+	"""
+	Makes sure that the iterations of a parallel for loop can run on their own
+	in another process. They can print, but they can't return from the loop,
+	and the loop body can't use imported libraries, which might have side
+	effects. Functions defined elsewhere that the body calls aren't checked, so
+	libraries they use will still run in the worker processes.
+	"""
+	def check_parallel_body(self, tree, in_function=False):
+		if type(tree) is Leaf:
+			return
+		if tree.data == "return" and not in_function:
+			self.errors.append(TypeCheckError(tree, "You can't return from inside a parallel for loop."))
+		elif tree.data == "imp" or tree.data == "imported_command":
+			self.errors.append(TypeCheckError(tree, "You can't use libraries inside a parallel for loop because they might have side effects."))
+		else:
+			# Returning from a function defined in the loop only leaves the
+			# function.
+			in_function = in_function or tree.data == "function_def" or tree.data == "anonymous_func"
+			for child in tree.children:
+				self.check_parallel_body(child, in_function)
+
 	def add_native_function(self, name, argument_types, return_type, function):
 		self.variables[name] = NativeFunction(self, argument_types, return_type, function)
 
+# Expressions that are safe to evaluate earlier than written, or only once:
+# they don't call functions, so they can't print, and they can't raise an
+# error. Division and modulo only count when dividing by a nonzero number.
+pure_expressions = {
+	"or_expression", "and_expression", "not_expression", "compare_expression",
+	"sum_expression", "product_expression", "ifelse_expr", "tuple", "record",
+	"field_access", "value",
+}
+
+def is_pure(expr):
+	if type(expr) is Leaf:
+		return True
+	if expr.data not in pure_expressions:
+		return False
+	if expr.data == "product_expression" and expr.children[1].type != "MULTIPLY":
+		divisor = expr.children[2]
+		if type(divisor) is not Leaf or divisor.type != "NUMBER" or divisor.value == 0:
+			return False
+	elif expr.data == "record":
+		return all(is_pure(field.children[1]) for field in expr.children)
+	elif expr.data == "field_access":
+		return is_pure(expr.children[0])
+	return all(is_pure(child) for child in expr.children)
+
+# Two expressions with the same key always evaluate to the same value.
+def expression_key(expr):
+	if type(expr) is Leaf:
+		if expr.type in ("NAME", "NUMBER", "STRING", "BOOLEAN", "INT"):
+			# The Python type keeps 1, 1.0 and true apart.
+			return (expr.type, type(expr.value), expr.value)
+		# Operators only need their type, so `=` and `==` are the same.
+		return (expr.type,)
+	return (expr.data,) + tuple(expression_key(child) for child in expr.children)
+
+# Whether the child at `index` is only evaluated some of the time, like the
+# right side of `&&` or the branches of an if/else.
+def is_conditional(tree, index):
+	if tree.data == "or_expression" or tree.data == "and_expression":
+		return index == 2
+	if tree.data == "compare_expression":
+		# Only chained comparisons stop early.
+		left = tree.children[0]
+		return index == 2 and type(left) is Node and left.data == "compare_expression"
+	return index > 0 and tree.data in ("ifelse_expr", "if", "ifelse")
+
+# Whether the child at `index` is the left side of a chained comparison, like
+# `a < b` in `a < b < c`. The chain evaluates it itself and reuses its right
+# side, so it can't be replaced with its value.
+def is_chain_link(tree, index):
+	if tree.data != "compare_expression" or index != 0:
+		return False
+	left = tree.children[0]
+	return type(left) is Node and left.data == "compare_expression"
+
+def find_names(expr, names):
+	if type(expr) is Leaf:
+		if expr.type == "NAME":
+			names.add(expr.value)
+	elif expr.data == "record":
+		for field in expr.children:
+			find_names(field.children[1], names)
+	elif expr.data == "field_access":
+		find_names(expr.children[0], names)
+	else:
+		for child in expr.children:
+			find_names(child, names)
+
+def find_declared_names(tree, names):
+	if type(tree) is Leaf or tree.data == "function_def" or tree.data == "anonymous_func":
+		return
+	if tree.data == "declare" or tree.data == "for" or tree.data == "parallel_for":
+		names.add(get_name_type(tree.children[0])[0])
+	for child in tree.children:
+		find_declared_names(child, names)
+
+"""
+Rewrites the type checked tree so that pure expressions inside `for` loops
+that don't depend on anything the loop defines are evaluated once before the
+loop, and pure expressions repeated within an instruction are evaluated once
+before it. The values are stored in variables whose names (`%0`, `%1`, ...)
+can't be written in N code.
+"""
+class Optimizer:
+	def __init__(self):
+		self.temp_count = 0
+
+	def optimize_block(self, instructions):
+		optimized = []
+		for instruction in instructions:
+			optimized.extend(self.optimize_instruction(instruction))
+		return tuple(optimized)
+
+	"""
+	Returns the instructions that should replace the given instruction.
+	"""
+	def optimize_instruction(self, instruction):
+		self.optimize_code_blocks(instruction)
+		command = instruction.children[0]
+
+		hoisted = {}
+		if command.data == "for" or command.data == "parallel_for":
+			var, _, code = command.children
+			defined = {get_name_type(var)[0]}
+			find_declared_names(code, defined)
+			def is_invariant(expr):
+				names = set()
+				find_names(expr, names)
+				return names.isdisjoint(defined)
+			code.children = tuple(
+				self.replace_expressions(child, is_invariant, hoisted, skip_code_blocks=False)
+				for child in code.children
+			)
+
+		# Replace the biggest repeated expression first, since replacing it
+		# also removes the repeats of the expressions inside it. Those can
+		# still be repeated in the declarations, so they're searched too.
+		# Only expressions that would always be evaluated at least once are
+		# shared, so that they're never evaluated when they otherwise wouldn't.
+		shared = {}
+		while True:
+			declarations = list(shared.values())
+			counts = {}
+			for tree in declarations + [instruction]:
+				self.count_expressions(tree, counts, False)
+			repeated = [key for key, (count, _, always) in counts.items() if count > 1 and always]
+			if not repeated:
+				break
+			key = max(repeated, key=lambda key: counts[key][1])
+			new_shared = {}
+			for tree in declarations + [instruction]:
+				self.replace_expressions(tree, lambda expr: expression_key(expr) == key, new_shared)
+			# The new declaration might be used by the earlier ones.
+			new_shared.update(shared)
+			shared = new_shared
+
+		return list(hoisted.values()) + list(shared.values()) + [instruction]
+
+	def optimize_code_blocks(self, tree):
+		if type(tree) is Leaf:
+			return
+		if tree.data == "code_block":
+			tree.children = self.optimize_block(tree.children)
+		else:
+			for child in tree.children:
+				self.optimize_code_blocks(child)
+
+	"""
+	Counts the pure expressions in a tree by their key, along with their size
+	and whether any of them are always evaluated. Code blocks are skipped
+	because they're their own instructions, and so are functions because their
+	arguments might shadow other variables.
+	"""
+	def count_expressions(self, tree, counts, conditional, replaceable=True):
+		if type(tree) is Leaf:
+			return 1
+		if tree.data in ("code_block", "function_def", "anonymous_func"):
+			return 0
+		size = 1
+		for index, child in enumerate(tree.children):
+			size += self.count_expressions(child, counts, conditional or is_conditional(tree, index), not is_chain_link(tree, index))
+		if replaceable and is_pure(tree):
+			key = expression_key(tree)
+			count, _, always = counts.get(key, (0, size, False))
+			counts[key] = (count + 1, size, always or not conditional)
+		return size
+
+	"""
+	Replaces pure expressions that `should_replace` accepts with variables,
+	adding a declaration to `declarations` for each different expression.
+	"""
+	def replace_expressions(self, tree, should_replace, declarations, skip_code_blocks=True, replaceable=True):
+		if type(tree) is Leaf or tree.data == "function_def" or tree.data == "anonymous_func":
+			return tree
+		if skip_code_blocks and tree.data == "code_block":
+			return tree
+		if replaceable and is_pure(tree) and should_replace(tree):
+			key = expression_key(tree)
+			if key not in declarations:
+				name = "%%%d" % self.temp_count
+				self.temp_count += 1
+				declarations[key] = Node("instruction", (
+					Node("declare", (Node("name_type", (Leaf("NAME", name),)), tree)),
+				))
+			return Leaf("NAME", get_name_type(declarations[key].children[0].children[0])[0])
+		tree.children = tuple(
+			self.replace_expressions(child, should_replace, declarations, skip_code_blocks, not is_chain_link(tree, index))
+			for index, child in enumerate(tree.children)
+		)
+		return tree
+
+# The loop that `run_parallel_chunk` runs a chunk of. The workers are forked,
+# so they get the scope and code from here instead of having them pickled.
+parallel_loop = None
+
+def run_parallel_chunk(start, stop):
+	scope, name, type, code = parallel_loop
+	output = io.StringIO()
+	with contextlib.redirect_stdout(output):
+		scope.eval_for(name, type, range(start, stop), code)
+	return output.getvalue()
+
 with open("syntax.lark", "r") as f:
 	parse = f.read()
 n_parser = Lark(parse, start="start", propagate_positions=True)
@@ -670,6 +1213,8 @@ n_parser = Lark(parse, start="start", propagate_positions=True)
 parser = argparse.ArgumentParser(description='Allows to only show warnings and choose the file location')
 parser.add_argument('--file', type=str, default="run.n", help="The file to read. (optional. if not included, it'll just run run.n)")
 parser.add_argument('--check', action='store_true')
+parser.add_argument('--no-optimize', action='store_true', help="Run the code as written, without moving or sharing repeated calculations.")
+parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="How many processes parallel for loops can use. (optional. defaults to the number of CPUs)")
 
 args = parser.parse_args()
 
@@ -686,6 +1231,12 @@ global_scope.add_native_function(
 	"str",
 	lambda number: str(number),
 )
+global_scope.add_native_function(
+	"strToInt",
+	[("string", "str")],
+	"int",
+	lambda string: int(string),
+)
 
 global_scope.add_native_function(
 	"round",
@@ -708,6 +1259,7 @@ global_scope.add_native_function(
 
 def type_check(file, tree):
 	scope = global_scope.new_scope()
+	scope.errors.extend(file.errors)
 	if tree.data == "start":
 		for child in tree.children:
 			scope.type_check_command(child)
@@ -740,4 +1292,6 @@ if error_count > 0 or args.check:
 		warning_s = "s"
 	print(f"{Fore.BLUE}Ran with {Fore.RED}{error_count} error{error_s}{Fore.BLUE} and {Fore.YELLOW}{warning_count} warning{warning_s}{Fore.BLUE}.{Style.RESET_ALL}")
 	exit()
+if not args.no_optimize:
+	tree.children = Optimizer().optimize_block(tree.children)
 parse_tree(tree)